@@ -1,11 +1,22 @@
 import itertools
+import json
 import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Literal
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy.optimize import minimize
+from scipy.special import logsumexp
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.linear_model import LinearRegression
 
+RESULTS_STORE = "ConjointResults"
+NUM_SEGMENTS = 3
+PARALLEL_SEGMENTATION_MIN_RESPONDENTS = 50_000
+
 
 def load_attributes(attributes_file):
     """Load attributes from Excel or CSV file and validate."""
@@ -119,6 +130,128 @@ def perform_regression(X, y, dummy_vars):
     return part_worths, intercept
 
 
+def load_choices(choices_file: str) -> pd.DataFrame | None:
+    """Load choice-based conjoint tasks from Excel or CSV file and validate."""
+    try:
+        if choices_file.endswith(".xlsx"):
+            choices_df = pd.read_excel(choices_file)
+        elif choices_file.endswith(".csv"):
+            choices_df = pd.read_csv(choices_file)
+        else:
+            print(f"Error: Unsupported file format for {choices_file}")
+            return None
+    except FileNotFoundError:
+        print(f"Error: {choices_file} not found.")
+        return None
+
+    required_columns = {"Respondent ID", "Task", "Profile Number", "Chosen"}
+    if not required_columns.issubset(choices_df.columns):
+        print(f"Error: Choices file must contain columns: {required_columns}")
+        return None
+
+    # Check for missing choices
+    if choices_df[list(required_columns)].isnull().any().any():
+        print("Error: Missing values detected in the Choices file.")
+        return None
+
+    # Check that every alternative is marked as chosen (1) or not chosen (0)
+    if not choices_df["Chosen"].isin([0, 1]).all():
+        print("Error: The Chosen column must contain only 0 or 1.")
+        return None
+
+    return choices_df
+
+
+def prepare_choice_data(
+    profiles_df: pd.DataFrame, choices_df: pd.DataFrame
+) -> tuple[np.ndarray | None, np.ndarray | None, pd.DataFrame | None]:
+    """Prepare choice tasks for multinomial logit estimation.
+
+    Returns an (n_tasks, n_alternatives) array of profile row indices, the index of the chosen
+    alternative in each task, and the dummy-coded profile design.
+    """
+    # Include all dummy variables without dropping any levels
+    dummy_vars = pd.get_dummies(profiles_df.drop(["Profile Number"], axis=1), drop_first=False)
+
+    if choices_df.empty:
+        print("Error: The Choices file contains no choice tasks.")
+        return None, None, None
+
+    # Map profile numbers to rows of the design matrix
+    positions = pd.Index(profiles_df["Profile Number"]).get_indexer(choices_df["Profile Number"])
+    if (positions < 0).any():
+        print("Error: The Choices file references profile numbers that are not in the generated profiles.")
+        return None, None, None
+
+    # Group rows into tasks; every task must show the same number of alternatives
+    task_ids = choices_df.groupby(["Respondent ID", "Task"], sort=False).ngroup().to_numpy()
+    order = np.argsort(task_ids, kind="stable")
+    task_sizes = np.bincount(task_ids)
+    if task_sizes.min() != task_sizes.max():
+        print("Error: Every choice task must contain the same number of alternatives.")
+        return None, None, None
+    num_alternatives = int(task_sizes[0])
+
+    alternatives = positions[order].reshape(-1, num_alternatives)
+    chosen = choices_df["Chosen"].to_numpy()[order].reshape(-1, num_alternatives)
+    if not ((chosen == 1).sum(axis=1) == 1).all():
+        print("Error: Every choice task must have exactly one chosen alternative.")
+        return None, None, None
+
+    return alternatives, (chosen == 1).argmax(axis=1), dummy_vars
+
+
+def perform_mnl(
+    alternatives: np.ndarray,
+    chosen: np.ndarray,
+    dummy_vars: pd.DataFrame,
+    batch_size: int = 100_000,
+    l2_penalty: float = 1e-4,
+) -> tuple[pd.DataFrame | None, float | None]:
+    """Estimate part-worth utilities with a multinomial logit model.
+
+    Utilities are computed once per profile and gathered per task, and tasks are processed in
+    minibatches of ``batch_size``, so memory stays flat as the number of tasks grows. A small L2
+    penalty keeps the estimates finite when a level is always (or never) chosen. Returns the
+    part-worths and the (unpenalized) log-likelihood of the fit.
+    """
+    if batch_size < 1:
+        print("Error: The batch size must be at least 1.")
+        return None, None
+
+    design = dummy_vars.to_numpy(dtype=float)
+    num_profiles = design.shape[0]
+    num_tasks = alternatives.shape[0]
+    chosen_profiles = alternatives[np.arange(num_tasks), chosen]
+    chosen_counts = np.bincount(chosen_profiles, minlength=num_profiles)
+
+    def negative_log_likelihood(beta):
+        profile_utilities = design @ beta
+        log_likelihood = profile_utilities[chosen_profiles].sum()
+        expected_counts = np.zeros(num_profiles)
+        for start in range(0, num_tasks, batch_size):
+            batch = alternatives[start : start + batch_size]
+            utilities = profile_utilities[batch]
+            log_denominators = logsumexp(utilities, axis=1)
+            log_likelihood -= log_denominators.sum()
+            probabilities = np.exp(utilities - log_denominators[:, None])
+            expected_counts += np.bincount(batch.ravel(), weights=probabilities.ravel(), minlength=num_profiles)
+
+        loss = -log_likelihood + l2_penalty * beta @ beta
+        gradient = design.T @ (expected_counts - chosen_counts) + 2 * l2_penalty * beta
+        return loss, gradient
+
+    result = minimize(negative_log_likelihood, np.zeros(design.shape[1]), jac=True, method="L-BFGS-B")
+    if not result.success:
+        print(f"Warning: MNL estimation did not converge: {result.message}")
+
+    # Create a DataFrame for part-worth utilities
+    part_worths = pd.DataFrame({"Attribute": dummy_vars.columns, "Part-Worth": result.x})
+
+    log_likelihood = -float(result.fun) + l2_penalty * float(result.x @ result.x)
+    return part_worths, log_likelihood
+
+
 def calculate_importance(part_worths, attributes):
     """Calculate attribute importance based on part-worth utilities."""
     importance = {}
@@ -135,23 +268,194 @@ def calculate_importance(part_worths, attributes):
     return importance_df
 
 
-def save_results(part_worths, importance_df):
-    """Save the part-worth utilities and attribute importances to CSV files."""
-    part_worths.to_csv("PartWorthUtilities.csv", index=False)
-    importance_df.to_csv("AttributeImportances.csv", index=False)
+def estimate_respondent_part_worths(ratings_df: pd.DataFrame, dummy_vars: pd.DataFrame) -> pd.DataFrame:
+    """Estimate part-worth utilities for every respondent in a single vectorized least-squares solve."""
+    # The pseudo-inverse gives the same minimum-norm solution as perform_regression, one respondent per row
+    design_pinv = np.linalg.pinv(dummy_vars.to_numpy(dtype=float))
+    ratings = ratings_df.drop("Respondent ID", axis=1).to_numpy(dtype=float)
+    utilities = ratings @ design_pinv.T
+    return pd.DataFrame(utilities, index=ratings_df["Respondent ID"], columns=dummy_vars.columns)
+
+
+def _fit_segmentation(utilities: np.ndarray, num_segments: int, batch_size: int, seed: int) -> MiniBatchKMeans:
+    """Fit one mini-batch k-means restart."""
+    model = MiniBatchKMeans(n_clusters=num_segments, batch_size=batch_size, n_init=1, random_state=seed)
+    return model.fit(utilities)
+
+
+_worker_utilities = np.empty((0, 0))
+
+
+def _init_segmentation_worker(utilities: np.ndarray) -> None:
+    """Receive the respondent utilities once per worker process."""
+    global _worker_utilities
+    _worker_utilities = utilities
+
+
+def _fit_segmentation_in_worker(num_segments: int, batch_size: int, seed: int) -> MiniBatchKMeans:
+    """Fit one mini-batch k-means restart on the worker's copy of the utilities."""
+    return _fit_segmentation(_worker_utilities, num_segments, batch_size, seed)
+
+
+def segment_respondents(
+    respondent_part_worths: pd.DataFrame,
+    num_segments: int = NUM_SEGMENTS,
+    num_restarts: int = 4,
+    batch_size: int = 1024,
+    max_workers: int | None = None,
+    random_state: int = 0,
+) -> pd.Series | None:
+    """Cluster respondents into preference segments by their part-worth utilities.
+
+    Runs ``num_restarts`` mini-batch k-means fits and keeps the one with the lowest inertia. With
+    ``max_workers`` left as None, panels smaller than PARALLEL_SEGMENTATION_MIN_RESPONDENTS are fit
+    serially and larger ones use up to one process per restart; each worker receives the utilities
+    once. Returns the segment label (numbered from 1) of each respondent.
+    """
+    num_respondents = len(respondent_part_worths)
+    if num_segments < 1 or num_segments > num_respondents:
+        print(f"Error: Cannot form {num_segments} segments from {num_respondents} respondents.")
+        return None
+
+    if num_restarts < 1:
+        print("Error: The number of restarts must be at least 1.")
+        return None
 
-    print("Conjoint analysis completed successfully.")
-    print("Results saved to 'PartWorthUtilities.csv' and 'AttributeImportances.csv'.")
+    if batch_size < 1:
+        print("Error: The batch size must be at least 1.")
+        return None
 
+    utilities = respondent_part_worths.to_numpy(dtype=float)
+    seeds = [int(seed) for seed in np.random.SeedSequence(random_state).generate_state(num_restarts)]
+    if max_workers is None:
+        if num_respondents < PARALLEL_SEGMENTATION_MIN_RESPONDENTS:
+            max_workers = 1
+        else:
+            max_workers = min(num_restarts, os.cpu_count() or 1)
+
+    if num_restarts == 1 or max_workers == 1:
+        models = [_fit_segmentation(utilities, num_segments, batch_size, seed) for seed in seeds]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_segmentation_worker, initargs=(utilities,)
+        ) as executor:
+            models = list(
+                executor.map(
+                    _fit_segmentation_in_worker,
+                    [num_segments] * num_restarts,
+                    [batch_size] * num_restarts,
+                    seeds,
+                )
+            )
+
+    best_model = min(models, key=lambda model: model.inertia_)
+    return pd.Series(best_model.labels_ + 1, index=respondent_part_worths.index, name="Segment")
+
+
+def summarize_segments(
+    respondent_part_worths: pd.DataFrame, segments: pd.Series, attributes: dict
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Report the size, mean part-worth utilities and attribute importances of each segment."""
+    sizes = segments.value_counts().sort_index()
+    total = sizes.sum()
+    segments_df = pd.DataFrame(
+        {
+            "Segment": sizes.index,
+            "Size": sizes.to_numpy(),
+            "Share (%)": (sizes.to_numpy() / total) * 100 if total != 0 else 0.0,
+        }
+    )
 
-def plot_importance(importance_df):
-    """Generate a bar chart for attribute importances."""
-    importance_df.plot(kind="bar", x="Attribute", y="Importance (%)")
-    plt.title("Attribute Importances")
-    plt.ylabel("Importance (%)")
-    plt.tight_layout()
-    plt.savefig("AttributeImportances.png")
-    print("Attribute importances chart saved as 'AttributeImportances.png'.")
+    mean_part_worths = respondent_part_worths.groupby(segments.to_numpy()).mean()
+    segment_part_worths = []
+    segment_importances = []
+    for segment, row in mean_part_worths.iterrows():
+        part_worths = pd.DataFrame({"Attribute": row.index, "Part-Worth": row.to_numpy()})
+        importance_df = calculate_importance(part_worths, attributes)
+        segment_part_worths.append(part_worths.assign(Segment=segment))
+        segment_importances.append(importance_df.assign(Segment=segment))
+
+    segment_part_worths_df = pd.concat(segment_part_worths, ignore_index=True)[["Segment", "Attribute", "Part-Worth"]]
+    segment_importances_df = pd.concat(segment_importances, ignore_index=True)[
+        ["Segment", "Attribute", "Importance (%)"]
+    ]
+    return segments_df, segment_part_worths_df, segment_importances_df
+
+
+def create_result_version(store_dir: str = RESULTS_STORE) -> str:
+    """Create and return a new numbered version directory (v0001, v0002, ...) inside the result store."""
+    os.makedirs(store_dir, exist_ok=True)
+    existing = [int(name[1:]) for name in os.listdir(store_dir) if name.startswith("v") and name[1:].isdigit()]
+    version = max(existing, default=0) + 1
+    while True:
+        version_dir = os.path.join(store_dir, f"v{version:04d}")
+        try:
+            # mkdir is atomic, so concurrent runs never share a version
+            os.mkdir(version_dir)
+            return version_dir
+        except FileExistsError:
+            version += 1
+
+
+def write_result_table(version_dir: str, table_name: str, df: pd.DataFrame) -> None:
+    """Write a DataFrame to the result store as one .npy file per column."""
+    table_dir = os.path.join(version_dir, table_name)
+    os.makedirs(table_dir, exist_ok=True)
+    for i, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        # Object columns cannot be memory-mapped, so store them as fixed-width strings
+        if values.dtype == object:
+            values = values.astype(str)
+        np.save(os.path.join(table_dir, f"{i:03d}.npy"), values)
+    with open(os.path.join(table_dir, "columns.json"), "w") as f:
+        json.dump([str(column) for column in df.columns], f)
+
+
+def load_result_table(
+    version_dir: str, table_name: str, mmap_mode: Literal["r", "r+", "c"] | None = "r"
+) -> dict[str, np.ndarray]:
+    """Load a table from the result store as a dict of (memory-mapped by default) column arrays."""
+    table_dir = os.path.join(version_dir, table_name)
+    with open(os.path.join(table_dir, "columns.json")) as f:
+        columns = json.load(f)
+    return {
+        column: np.load(os.path.join(table_dir, f"{i:03d}.npy"), mmap_mode=mmap_mode)
+        for i, column in enumerate(columns)
+    }
+
+
+def render_importance_chart(importance_df: pd.DataFrame, chart_file: str) -> str:
+    """Render the attribute importances bar chart with the Agg backend and save it."""
+    # Use a standalone Figure rather than pyplot so rendering is safe off the main thread
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.bar(importance_df["Attribute"].astype(str), importance_df["Importance (%)"])
+    ax.set_title("Attribute Importances")
+    ax.set_ylabel("Importance (%)")
+    ax.tick_params(axis="x", labelrotation=90)
+    fig.tight_layout()
+    fig.savefig(chart_file)
+    return chart_file
+
+
+def save_results_to_store(
+    tables: dict[str, pd.DataFrame],
+    importance_df: pd.DataFrame,
+    executor: ThreadPoolExecutor,
+    store_dir: str = RESULTS_STORE,
+) -> tuple[str, Future]:
+    """Save result tables to a new result store version, rendering the chart in the background.
+
+    The chart renders on ``executor`` while the tables are written. Returns the version directory and
+    the chart's future, which the caller should join before exiting.
+    """
+    version_dir = create_result_version(store_dir)
+    chart_file = os.path.join(version_dir, "AttributeImportances.png")
+    chart_future = executor.submit(render_importance_chart, importance_df, chart_file)
+    for table_name, df in tables.items():
+        write_result_table(version_dir, table_name, df)
+    return version_dir, chart_future
 
 
 def main():
@@ -171,12 +475,17 @@ def main():
             print("Error: Neither 'Attributes.xlsx' nor 'Attributes.csv' found.")
             return
 
-    # Try to find Ratings file
+    # Try to find a Choices file (choice-based conjoint), falling back to a Ratings file
+    choices_file = os.path.join(script_dir, "Choices.xlsx")
+    if not os.path.exists(choices_file):
+        choices_file = os.path.join(script_dir, "Choices.csv")
+    choice_based = os.path.exists(choices_file)
+
     ratings_file = os.path.join(script_dir, "Ratings.xlsx")
-    if not os.path.exists(ratings_file):
+    if not choice_based and not os.path.exists(ratings_file):
         ratings_file = os.path.join(script_dir, "Ratings.csv")
         if not os.path.exists(ratings_file):
-            print("Error: Neither 'Ratings.xlsx' nor 'Ratings.csv' found.")
+            print("Error: None of 'Choices.xlsx', 'Choices.csv', 'Ratings.xlsx' or 'Ratings.csv' found.")
             return
 
     profiles_file = "GeneratedProfiles.csv"
@@ -191,35 +500,81 @@ def main():
 
     # Save profiles
     save_profiles(profiles_df, profiles_file)
+    segment_tables = {}
+
+    if choice_based:
+        # Prompt user to collect choices
+        input(
+            "Please collect respondent choices for the generated profiles.\n"
+            "Use the 'Choices.xlsx' or 'Choices.csv' template and save it in the same directory.\n"
+            "Press Enter to continue after you have collected the choices..."
+        )
+
+        # Load choices
+        choices_df = load_choices(choices_file)
+        if choices_df is None:
+            return
 
-    # Prompt user to collect ratings
-    input(
-        "Please collect respondent ratings for the generated profiles.\n"
-        "Use the 'Ratings.xlsx' or 'Ratings.csv' template and save it in the same directory.\n"
-        "Press Enter to continue after you have collected the ratings..."
-    )
+        # Prepare data for MNL estimation
+        alternatives, chosen, dummy_vars = prepare_choice_data(profiles_df, choices_df)
+        if alternatives is None or chosen is None or dummy_vars is None:
+            return
 
-    # Load ratings
-    ratings_df = load_ratings(ratings_file)
-    if ratings_df is None:
-        return
+        # Estimate the multinomial logit model
+        part_worths, _log_likelihood = perform_mnl(alternatives, chosen, dummy_vars)
+        if part_worths is None:
+            return
 
-    # Prepare data for regression
-    X, y, dummy_vars = prepare_regression_data(profiles_df, ratings_df)
-    if X is None:
-        return
+        print("Skipping segmentation: choice-based surveys have too few tasks per respondent to segment.")
+    else:
+        # Prompt user to collect ratings
+        input(
+            "Please collect respondent ratings for the generated profiles.\n"
+            "Use the 'Ratings.xlsx' or 'Ratings.csv' template and save it in the same directory.\n"
+            "Press Enter to continue after you have collected the ratings..."
+        )
+
+        # Load ratings
+        ratings_df = load_ratings(ratings_file)
+        if ratings_df is None:
+            return
 
-    # Perform regression
-    part_worths, _intercept = perform_regression(X, y, dummy_vars)
+        # Prepare data for regression
+        X, y, dummy_vars = prepare_regression_data(profiles_df, ratings_df)
+        if X is None:
+            return
+
+        # Perform regression
+        part_worths, _intercept = perform_regression(X, y, dummy_vars)
+
+        # Segment respondents by their individual part-worths
+        respondent_part_worths = estimate_respondent_part_worths(ratings_df, dummy_vars)
+        if len(respondent_part_worths) >= NUM_SEGMENTS:
+            segments = segment_respondents(respondent_part_worths)
+            if segments is not None:
+                segments_df, segment_part_worths_df, segment_importances_df = summarize_segments(
+                    respondent_part_worths, segments, attributes
+                )
+                segment_tables = {
+                    "segments": segments_df,
+                    "segment_part_worths": segment_part_worths_df,
+                    "segment_importances": segment_importances_df,
+                }
+        else:
+            print(f"Skipping segmentation: fewer than {NUM_SEGMENTS} respondents.")
 
     # Calculate attribute importance
     importance_df = calculate_importance(part_worths, attributes)
 
-    # Save results
-    save_results(part_worths, importance_df)
-
-    # Plot attribute importance
-    plot_importance(importance_df)
+    # Save results only now that estimation has succeeded, rendering the chart while the tables are written
+    tables = {"profiles": profiles_df, "part_worths": part_worths, "importances": importance_df, **segment_tables}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        version_dir, chart_future = save_results_to_store(tables, importance_df, executor)
+        print(f"Conjoint analysis completed successfully. Results saved to '{version_dir}'.")
+        print(importance_df.to_string(index=False))
+        if segment_tables:
+            print(segment_tables["segments"].to_string(index=False))
+    print(f"Attribute importances chart saved as '{chart_future.result()}'.")
 
 
 if __name__ == "__main__":
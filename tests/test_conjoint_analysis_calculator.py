@@ -0,0 +1,314 @@
+"""Tests for the conjoint analysis calculator."""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conjoint_analysis_calculator import conjoint_analysis_calculator as cac
+
+
+@pytest.fixture
+def profiles() -> tuple[pd.DataFrame, dict]:
+    """Generate a small full-factorial design with three categorical attributes."""
+    attributes_df = pd.DataFrame(
+        {
+            "Attribute Name": ["Color", "Size", "Brand"],
+            "Level 1": ["Red", "Small", "Acme"],
+            "Level 2": ["Blue", "Large", "Bolt"],
+            "Level 3": ["Green", None, "Crest"],
+        }
+    )
+    profiles_df, attributes = cac.generate_profiles(attributes_df)
+    return profiles_df, attributes
+
+
+def simulate_choices(profiles_df: pd.DataFrame, part_worths: np.ndarray, num_tasks: int, seed: int = 0) -> pd.DataFrame:
+    """Simulate MNL choices (Gumbel errors) in the long format read by load_choices."""
+    rng = np.random.default_rng(seed)
+    design = pd.get_dummies(profiles_df.drop(["Profile Number"], axis=1)).to_numpy(dtype=float)
+    num_alternatives = 3
+    alternatives = np.array([rng.choice(len(profiles_df), num_alternatives, replace=False) for _ in range(num_tasks)])
+    utilities = (design @ part_worths)[alternatives] + rng.gumbel(size=alternatives.shape)
+    chosen = utilities.argmax(axis=1)
+    return pd.DataFrame(
+        {
+            "Respondent ID": np.repeat(np.arange(num_tasks) // 10, num_alternatives),
+            "Task": np.repeat(np.arange(num_tasks) % 10, num_alternatives),
+            "Profile Number": profiles_df["Profile Number"].to_numpy()[alternatives.ravel()],
+            "Chosen": (np.arange(num_alternatives) == chosen[:, None]).ravel().astype(int),
+        }
+    )
+
+
+def within_attribute_differences(part_worths: pd.DataFrame, attributes: dict) -> np.ndarray:
+    """Part-worths relative to each attribute's first level, which MNL identifies."""
+    differences = []
+    for attribute in attributes:
+        levels = part_worths[part_worths["Attribute"].str.startswith(attribute)]["Part-Worth"].to_numpy()
+        differences.extend(levels - levels[0])
+    return np.array(differences)
+
+
+def test_mnl_recovers_known_part_worths(profiles: tuple[pd.DataFrame, dict]) -> None:
+    """MNL estimates match the part-worths used to simulate the choices."""
+    profiles_df, attributes = profiles
+    true_part_worths = np.array([0.5, -0.3, 0.0, 0.8, -0.2, 0.4, -0.6, 0.1])
+    choices_df = simulate_choices(profiles_df, true_part_worths, num_tasks=20_000)
+
+    alternatives, chosen, dummy_vars = cac.prepare_choice_data(profiles_df, choices_df)
+    assert alternatives is not None and chosen is not None and dummy_vars is not None
+    part_worths, log_likelihood = cac.perform_mnl(alternatives, chosen, dummy_vars)
+    assert part_worths is not None and log_likelihood is not None
+
+    expected = pd.DataFrame({"Attribute": dummy_vars.columns, "Part-Worth": true_part_worths})
+    np.testing.assert_allclose(
+        within_attribute_differences(part_worths, attributes),
+        within_attribute_differences(expected, attributes),
+        atol=0.1,
+    )
+    assert log_likelihood < 0
+
+
+def test_mnl_is_independent_of_batch_size(profiles: tuple[pd.DataFrame, dict]) -> None:
+    """Minibatching changes memory use, not the estimates."""
+    profiles_df, _ = profiles
+    choices_df = simulate_choices(profiles_df, np.linspace(-1, 1, 8), num_tasks=2_000)
+    alternatives, chosen, dummy_vars = cac.prepare_choice_data(profiles_df, choices_df)
+    assert alternatives is not None and chosen is not None and dummy_vars is not None
+
+    full_batch, full_log_likelihood = cac.perform_mnl(alternatives, chosen, dummy_vars, batch_size=10_000)
+    minibatch, minibatch_log_likelihood = cac.perform_mnl(alternatives, chosen, dummy_vars, batch_size=64)
+    assert full_batch is not None and minibatch is not None
+
+    np.testing.assert_allclose(full_batch["Part-Worth"], minibatch["Part-Worth"], atol=1e-6)
+    assert full_log_likelihood == pytest.approx(minibatch_log_likelihood)
+
+
+def test_perform_mnl_rejects_empty_batches(profiles: tuple[pd.DataFrame, dict]) -> None:
+    """A batch size below 1 returns None instead of raising."""
+    profiles_df, _ = profiles
+    choices_df = simulate_choices(profiles_df, np.zeros(8), num_tasks=10)
+    alternatives, chosen, dummy_vars = cac.prepare_choice_data(profiles_df, choices_df)
+    assert alternatives is not None and chosen is not None and dummy_vars is not None
+    assert cac.perform_mnl(alternatives, chosen, dummy_vars, batch_size=0) == (None, None)
+
+
+def test_prepare_choice_data_picks_the_chosen_alternative(profiles: tuple[pd.DataFrame, dict]) -> None:
+    """The chosen index points at the alternative marked 1, whatever the row order."""
+    profiles_df, _ = profiles
+    choices_df = pd.DataFrame(
+        {
+            "Respondent ID": [2, 1, 1, 2, 1, 2],
+            "Task": [1, 1, 1, 1, 1, 1],
+            "Profile Number": [4, 1, 2, 5, 3, 6],
+            "Chosen": [0, 0, 1, 1, 0, 0],
+        }
+    )
+    alternatives, chosen, _ = cac.prepare_choice_data(profiles_df, choices_df)
+    assert alternatives is not None and chosen is not None
+    assert sorted(alternatives[np.arange(2), chosen]) == [1, 4]
+
+
+@pytest.mark.parametrize(
+    ("tasks", "profile_numbers", "chosen"),
+    [
+        pytest.param([1, 1, 2, 2], [1, 2, 999, 4], [1, 0, 0, 1], id="unknown-profile"),
+        pytest.param([1, 1, 1, 2], [1, 2, 3, 4], [1, 0, 0, 1], id="unequal-alternatives"),
+        pytest.param([1, 1, 2, 2], [1, 2, 3, 4], [0, 0, 0, 1], id="no-choice"),
+        pytest.param([1, 1, 2, 2], [1, 2, 3, 4], [1, 1, 0, 1], id="two-choices"),
+    ],
+)
+def test_prepare_choice_data_rejects_invalid_tasks(
+    profiles: tuple[pd.DataFrame, dict], tasks: list[int], profile_numbers: list[int], chosen: list[int]
+) -> None:
+    """Invalid choice tasks return None instead of raising."""
+    profiles_df, _ = profiles
+    choices_df = pd.DataFrame(
+        {"Respondent ID": [1, 1, 1, 1], "Task": tasks, "Profile Number": profile_numbers, "Chosen": chosen}
+    )
+    assert cac.prepare_choice_data(profiles_df, choices_df) == (None, None, None)
+
+
+def test_prepare_choice_data_rejects_empty_choices(profiles: tuple[pd.DataFrame, dict]) -> None:
+    """A Choices file with headers only returns None instead of raising."""
+    profiles_df, _ = profiles
+    choices_df = pd.DataFrame(columns=["Respondent ID", "Task", "Profile Number", "Chosen"])
+    assert cac.prepare_choice_data(profiles_df, choices_df) == (None, None, None)
+
+
+def test_load_choices_rejects_non_binary_chosen(tmp_path) -> None:
+    """Chosen values other than 0 and 1 are rejected."""
+    choices_file = tmp_path / "Choices.csv"
+    pd.DataFrame(
+        {"Respondent ID": [1, 1, 1], "Task": [1, 1, 1], "Profile Number": [1, 2, 3], "Chosen": [1, 5, 0]}
+    ).to_csv(choices_file, index=False)
+    assert cac.load_choices(str(choices_file)) is None
+
+
+def test_load_choices_reads_valid_file(tmp_path) -> None:
+    """A well-formed Choices file loads unchanged."""
+    choices_file = tmp_path / "Choices.csv"
+    choices_df = pd.DataFrame(
+        {"Respondent ID": [1, 1, 1], "Task": [1, 1, 1], "Profile Number": [1, 2, 3], "Chosen": [0, 1, 0]}
+    )
+    choices_df.to_csv(choices_file, index=False)
+    pd.testing.assert_frame_equal(cac.load_choices(str(choices_file)), choices_df)
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        pytest.param("Respondent ID,Task,Profile Number\n1,1,1\n", id="missing-column"),
+        pytest.param("Respondent ID,Task,Profile Number,Chosen\n1,1,1,\n", id="missing-value"),
+    ],
+)
+def test_load_choices_rejects_malformed_file(tmp_path, contents: str) -> None:
+    """Missing columns or values are rejected."""
+    choices_file = tmp_path / "Choices.csv"
+    choices_file.write_text(contents)
+    assert cac.load_choices(str(choices_file)) is None
+
+
+def test_result_table_round_trips_as_memory_mapped_columns(tmp_path) -> None:
+    """Tables are written column by column and memory-mapped back, with object columns as strings."""
+    df = pd.DataFrame({"Attribute": ["Color_Red", "Size_Small"], "Part-Worth": [0.25, -1.5], "Flag": [True, False]})
+    cac.write_result_table(str(tmp_path), "part_worths", df)
+
+    columns = cac.load_result_table(str(tmp_path), "part_worths")
+
+    assert list(columns) == ["Attribute", "Part-Worth", "Flag"]
+    assert all(isinstance(values, np.memmap) for values in columns.values())
+    assert columns["Attribute"].dtype.kind == "U"
+    np.testing.assert_array_equal(columns["Attribute"], ["Color_Red", "Size_Small"])
+    np.testing.assert_array_equal(columns["Part-Worth"], [0.25, -1.5])
+    np.testing.assert_array_equal(columns["Flag"], [True, False])
+
+
+def test_create_result_version_numbers_versions(tmp_path) -> None:
+    """Each call claims the next version directory."""
+    store_dir = str(tmp_path / "store")
+    assert cac.create_result_version(store_dir) == str(tmp_path / "store" / "v0001")
+    assert cac.create_result_version(store_dir) == str(tmp_path / "store" / "v0002")
+
+
+def test_create_result_version_skips_existing_version(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A version created concurrently, after the store was listed, is skipped rather than reused."""
+    (tmp_path / "v0001").mkdir()
+    monkeypatch.setattr(cac.os, "listdir", lambda path: [])
+    assert cac.create_result_version(str(tmp_path)) == str(tmp_path / "v0002")
+
+
+def test_save_results_to_store_renders_chart_in_worker_thread(tmp_path) -> None:
+    """The chart is rendered by the executor while the tables are written."""
+    importance_df = pd.DataFrame({"Attribute": ["Color", "Size"], "Importance (%)": [60.0, 40.0]})
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        version_dir, chart_future = cac.save_results_to_store(
+            {"importances": importance_df}, importance_df, executor, store_dir=str(tmp_path)
+        )
+        chart_file = chart_future.result()
+
+    assert chart_file == os.path.join(version_dir, "AttributeImportances.png")
+    with open(chart_file, "rb") as f:
+        assert f.read(8) == b"\x89PNG\r\n\x1a\n"
+    np.testing.assert_array_equal(cac.load_result_table(version_dir, "importances")["Importance (%)"], [60.0, 40.0])
+
+
+@pytest.fixture
+def segmented_ratings(profiles: tuple[pd.DataFrame, dict]) -> tuple[pd.DataFrame, pd.DataFrame, np.ndarray]:
+    """Simulate ratings from three clearly separated preference segments."""
+    profiles_df, _ = profiles
+    dummy_vars = pd.get_dummies(profiles_df.drop(["Profile Number"], axis=1), drop_first=False)
+    rng = np.random.default_rng(0)
+    segment_part_worths = rng.normal(scale=3.0, size=(3, dummy_vars.shape[1]))
+    true_segments = np.repeat(np.arange(3), 40)
+    ratings = segment_part_worths[true_segments] @ dummy_vars.to_numpy(dtype=float).T
+    ratings += rng.normal(scale=0.1, size=ratings.shape)
+    ratings_df = pd.DataFrame(ratings, columns=[f"Profile {i}" for i in profiles_df["Profile Number"]])
+    ratings_df.insert(0, "Respondent ID", np.arange(len(true_segments)) + 1)
+    return ratings_df, dummy_vars, true_segments
+
+
+def test_respondent_part_worths_average_to_pooled_regression(
+    profiles: tuple[pd.DataFrame, dict], segmented_ratings: tuple[pd.DataFrame, pd.DataFrame, np.ndarray]
+) -> None:
+    """The mean of the per-respondent part-worths is the pooled regression solution."""
+    profiles_df, _ = profiles
+    ratings_df, dummy_vars, _ = segmented_ratings
+    X, y, _ = cac.prepare_regression_data(profiles_df, ratings_df)
+    pooled, _ = cac.perform_regression(X, y, dummy_vars)
+
+    respondent_part_worths = cac.estimate_respondent_part_worths(ratings_df, dummy_vars)
+
+    assert list(respondent_part_worths.index) == list(ratings_df["Respondent ID"])
+    np.testing.assert_allclose(respondent_part_worths.mean().to_numpy(), pooled["Part-Worth"], atol=1e-8)
+
+
+@pytest.mark.parametrize("max_workers", [None, 1, 2])
+def test_segment_respondents_recovers_separated_segments(
+    segmented_ratings: tuple[pd.DataFrame, pd.DataFrame, np.ndarray], max_workers: int | None
+) -> None:
+    """Respondents with clearly separated preferences share a segment, serially and across processes."""
+    ratings_df, dummy_vars, true_segments = segmented_ratings
+    respondent_part_worths = cac.estimate_respondent_part_worths(ratings_df, dummy_vars)
+
+    segments = cac.segment_respondents(respondent_part_worths, num_segments=3, max_workers=max_workers)
+
+    assert segments is not None
+    assert set(segments) == {1, 2, 3}
+    # Each true segment maps to exactly one found segment
+    pairs = set(zip(true_segments, segments, strict=True))
+    assert len(pairs) == 3
+
+
+@pytest.mark.parametrize(
+    ("num_segments", "num_restarts", "batch_size"),
+    [
+        pytest.param(0, 4, 1024, id="no-segments"),
+        pytest.param(121, 4, 1024, id="more-segments-than-respondents"),
+        pytest.param(3, 0, 1024, id="no-restarts"),
+        pytest.param(3, 4, 0, id="empty-batch"),
+    ],
+)
+def test_segment_respondents_rejects_invalid_settings(
+    segmented_ratings: tuple[pd.DataFrame, pd.DataFrame, np.ndarray],
+    num_segments: int,
+    num_restarts: int,
+    batch_size: int,
+) -> None:
+    """Invalid segmentation settings return None instead of raising."""
+    ratings_df, dummy_vars, _ = segmented_ratings
+    respondent_part_worths = cac.estimate_respondent_part_worths(ratings_df, dummy_vars)
+    segments = cac.segment_respondents(
+        respondent_part_worths, num_segments=num_segments, num_restarts=num_restarts, batch_size=batch_size
+    )
+    assert segments is None
+
+
+def test_summarize_segments_reports_sizes_part_worths_and_importances(
+    profiles: tuple[pd.DataFrame, dict], segmented_ratings: tuple[pd.DataFrame, pd.DataFrame, np.ndarray]
+) -> None:
+    """Segment shares sum to 100 and importances follow from each segment's mean part-worths."""
+    _, attributes = profiles
+    ratings_df, dummy_vars, _ = segmented_ratings
+    respondent_part_worths = cac.estimate_respondent_part_worths(ratings_df, dummy_vars)
+    segments = cac.segment_respondents(respondent_part_worths, num_segments=3, max_workers=1)
+    assert segments is not None
+
+    segments_df, segment_part_worths, segment_importances = cac.summarize_segments(
+        respondent_part_worths, segments, attributes
+    )
+
+    assert segments_df["Size"].sum() == len(respondent_part_worths)
+    assert segments_df["Share (%)"].sum() == pytest.approx(100)
+    for segment in segments_df["Segment"]:
+        members = respondent_part_worths[segments == segment]
+        part_worths = segment_part_worths[segment_part_worths["Segment"] == segment]
+        np.testing.assert_allclose(part_worths["Part-Worth"], members.mean().to_numpy())
+
+        expected = cac.calculate_importance(part_worths[["Attribute", "Part-Worth"]], attributes)
+        importances = segment_importances[segment_importances["Segment"] == segment]
+        np.testing.assert_allclose(importances["Importance (%)"], expected["Importance (%)"])
+        assert list(importances["Attribute"]) == list(expected["Attribute"])